@@ -1,2 +1,3 @@
 from .cpu_enrichments import rate_apply
-from .gpu_enrichments import pitch_apply, snr_apply, squim_apply
\ No newline at end of file
+from .gpu_enrichments import pitch_apply, snr_apply, squim_apply, gpu_enrichments_apply, enrich_split_gpu
+from .shards import enrich_shards
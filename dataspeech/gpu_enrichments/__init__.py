@@ -1,3 +1,5 @@
 from .pitch import pitch_apply
 from .snr_and_reverb import snr_apply
-from .squim import squim_apply
\ No newline at end of file
+from .squim import squim_apply
+from .fused import gpu_enrichments_apply
+from .loader import enrich_split_gpu
@@ -0,0 +1,253 @@
+from torchaudio.pipelines import SQUIM_OBJECTIVE
+from pyannote.audio import Model
+from pathlib import Path
+from brouhaha.pipeline import RegressiveActivityDetectionPipeline
+from huggingface_hub import hf_hub_download
+import torch
+import torchaudio
+import penn
+import torchcrepe
+import torchyin
+import numpy as np
+import contextlib
+
+from .pitch import hopsize, fmin, fmax, checkpoint, center, interp_unvoiced_at
+from .snr_and_reverb import ratio
+from .squim import max_audio_length
+
+SAMPLE_RATE = SQUIM_OBJECTIVE.sample_rate
+
+# clips may only share a padded SQUIM forward if the shortest one is within
+# this fraction of the longest, i.e. at most 10% of its tensor is padding
+SQUIM_PAD_TOLERANCE = 0.1
+
+# inference only: let Ampere+ tensor cores run matmuls/convs in TF32
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+
+def _autocast(device):
+    if device == "cpu":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+
+# lazily-loaded models, keyed by device so each device holds a single copy
+snr_pipelines = {}
+squim_models = {}
+
+# resampling kernels are precomputed per (source sample rate, device) so the
+# resample runs on the already-on-device tensor instead of on CPU in the decoder
+resamplers = {}
+
+
+def resample_waveform(waveform, orig_sr, device):
+    if orig_sr == SAMPLE_RATE:
+        return waveform
+    key = (orig_sr, device)
+    if key not in resamplers:
+        resampler = torchaudio.transforms.Resample(orig_sr, SAMPLE_RATE, resampling_method="sinc_interp_kaiser")
+        if device != "cpu":
+            resampler = resampler.to(device)
+        resamplers[key] = resampler
+    return resamplers[key](waveform)
+
+
+def _models_for_device(device, apply_squim_quality_estimation=False, snr_batch_size=32):
+    if device not in snr_pipelines:
+        model = Model.from_pretrained(
+            Path(hf_hub_download(repo_id="ylacombe/brouhaha-best", filename="best.ckpt")),
+            strict=False,
+        )
+        model.eval()
+        if device != "cpu":
+            model.to(device)
+        # no torch.compile here: the pipeline type-checks its segmentation
+        # model and rejects the OptimizedModule wrapper compile returns
+        pipeline = RegressiveActivityDetectionPipeline(segmentation=model, batch_size=snr_batch_size)
+        if device != "cpu":
+            pipeline.to(torch.device(device))
+        snr_pipelines[device] = pipeline
+    if apply_squim_quality_estimation and device not in squim_models:
+        model = SQUIM_OBJECTIVE.get_model()
+        model.eval()
+        if device != "cpu":
+            model.to(device)
+            # dynamic=True reuses the compiled graph across padded lengths
+            model = torch.compile(model, mode="reduce-overhead", dynamic=True)
+        else:
+            # SQUIM is LSTM/Linear heavy: INT8 dynamic quantization gives a 2-3x
+            # CPU speedup with negligible drift on the quality scores
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+        squim_models[device] = model
+    return snr_pipelines[device], squim_models.get(device)
+
+
+# rounding yin inputs up to whole seconds keeps the set of [B, T] shapes small,
+# so the statically-compiled kernel specialized for 16 kHz is reused across batches
+YIN_LENGTH_GRID = SAMPLE_RATE
+compiled_yin = None
+
+
+def _yin_kernel(device):
+    global compiled_yin
+    if device == "cpu":
+        return torchyin.estimate
+    if compiled_yin is None:
+        compiled_yin = torch.compile(torchyin.estimate, mode="max-autotune")
+    return compiled_yin
+
+
+def _pitch_batch(waveforms, padded, lengths, device, pitch_backend="yin", penn_batch_size=4096):
+    utterance_pitch_mean = []
+    utterance_pitch_std = []
+    if pitch_backend == "yin":
+        # torch-yin accepts [B, T], so the whole padded batch goes through one kernel
+        remainder = padded.shape[1] % YIN_LENGTH_GRID
+        if remainder:
+            padded = torch.nn.functional.pad(padded, (0, YIN_LENGTH_GRID - remainder))
+        pitch = _yin_kernel(device)(padded, sample_rate=SAMPLE_RATE, pitch_min=fmin, pitch_max=fmax, frame_stride=hopsize)
+        hop = int(hopsize * SAMPLE_RATE)
+        for i, length in enumerate(lengths):
+            # drop padding frames, then unvoiced frames (yin marks them with 0 Hz)
+            track = pitch[i, :max(1, length // hop)]
+            voiced = track[track > 0]
+            if voiced.numel() > 0:
+                track = voiced
+            utterance_pitch_mean.append(track.mean().cpu())
+            utterance_pitch_std.append(track.std().cpu())
+    elif pitch_backend == "crepe":
+        for waveform in waveforms:
+            pitch = torchcrepe.predict(
+                waveform[None, :],
+                SAMPLE_RATE,
+                hop_length=int(hopsize * SAMPLE_RATE),
+                fmin=fmin,
+                fmax=fmax,
+                model="full",
+                batch_size=penn_batch_size,
+                device=device,
+                )
+            utterance_pitch_mean.append(pitch.mean().cpu())
+            utterance_pitch_std.append(pitch.std().cpu())
+    elif pitch_backend == "penn":
+        gpu_index = torch.device(device).index if device != "cpu" else None
+        for waveform in waveforms:
+            pitch, periodicity = penn.from_audio(
+                waveform[None, :],
+                SAMPLE_RATE,
+                hopsize=hopsize,
+                fmin=fmin,
+                fmax=fmax,
+                checkpoint=checkpoint,
+                batch_size=penn_batch_size,
+                center=center,
+                interp_unvoiced_at=interp_unvoiced_at,
+                gpu=gpu_index
+                )
+            utterance_pitch_mean.append(pitch.mean().cpu())
+            utterance_pitch_std.append(pitch.std().cpu())
+    else:
+        raise ValueError(f"Unknown pitch backend '{pitch_backend}', expected 'penn', 'yin' or 'crepe'.")
+    return utterance_pitch_mean, utterance_pitch_std
+
+
+def enrich_waveforms(waveforms, device, pitch_backend="yin", penn_batch_size=4096, snr_batch_size=32, apply_squim_quality_estimation=False):
+    """Run pitch, snr/reverb and optionally SQUIM on a list of mono waveforms.
+
+    `waveforms` must be 1D float tensors already on `device` and resampled to
+    `SAMPLE_RATE`. Returns a dict of per-sample result lists.
+    """
+    snr_pipeline, squim_model = _models_for_device(device, apply_squim_quality_estimation, snr_batch_size)
+
+    # pad to [B, T] so models that accept batches run a single forward pass
+    lengths = [waveform.shape[-1] for waveform in waveforms]
+    padded = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True)
+
+    utterance_pitch_mean, utterance_pitch_std = _pitch_batch(waveforms, padded, lengths, device, pitch_backend=pitch_backend, penn_batch_size=penn_batch_size)
+
+    snr = []
+    c50 = []
+    vad_durations = []
+    # no autocast here: the pipeline converts its outputs to numpy internally,
+    # which raises on bf16 tensors and leaves us nowhere to cast back to float32
+    for waveform in waveforms:
+        waveform = waveform[None, :]
+        res = snr_pipeline({"sample_rate": SAMPLE_RATE, "waveform": waveform})
+
+        mask = np.full(res["snr"].shape, False)
+        for (segment, _) in res["annotation"].itertracks():
+            start = int(segment.start * ratio)
+            end = int(segment.end * ratio)
+            mask[start:end] = True
+        mask =  (~((res["snr"] == 0.0) & (res["c50"] == 0.0)) & mask)
+
+        vad_duration = sum(map(lambda x: x[0].duration, res["annotation"].itertracks()))
+
+        snr.append(res["snr"][mask].mean())
+        c50.append(res["c50"][mask].mean())
+        vad_durations.append(np.float32(vad_duration))
+
+    out = {
+        "utterance_pitch_mean": utterance_pitch_mean,
+        "utterance_pitch_std": utterance_pitch_std,
+        # 16ms window
+        "snr": snr,
+        "c50": c50,
+        "speech_duration": vad_durations,
+    }
+
+    if apply_squim_quality_estimation:
+        # SQUIM returns one scalar per clip, so padding cannot be sliced out of
+        # the outputs afterwards: only clips of near-equal length share a padded
+        # forward pass, so trailing zeros never distort a short clip's scores
+        sdr = [None] * len(waveforms)
+        pesq = [None] * len(waveforms)
+        stoi = [None] * len(waveforms)
+        capped = [min(length, max_audio_length) for length in lengths]
+        order = sorted(range(len(waveforms)), key=capped.__getitem__)
+        start = 0
+        while start < len(order):
+            stop = start + 1
+            while stop < len(order) and capped[order[start]] >= (1 - SQUIM_PAD_TOLERANCE) * capped[order[stop]]:
+                stop += 1
+            group = order[start:stop]
+            group_padded = torch.nn.utils.rnn.pad_sequence([waveforms[i][:max_audio_length] for i in group], batch_first=True)
+            with torch.no_grad(), _autocast(device):
+                stoi_batch, pesq_batch, sdr_batch = squim_model(group_padded)
+            for k, i in enumerate(group):
+                sdr[i] = sdr_batch[k].float().cpu()
+                pesq[i] = pesq_batch[k].float().cpu()
+                stoi[i] = stoi_batch[k].float().cpu()
+            start = stop
+        out["sdr"] = sdr
+        out["pesq"] = pesq
+        out["stoi"] = stoi
+    return out
+
+
+def gpu_enrichments_apply(batch, rank=None, audio_column_name="audio", pitch_backend="yin", penn_batch_size=4096, snr_batch_size=32, apply_squim_quality_estimation=False):
+    if rank is not None or torch.cuda.device_count() > 0:
+        device = f"cuda:{(rank or 0)% torch.cuda.device_count()}"
+    else:
+        device = "cpu"
+
+    # pull the audio structs apart into parallel arrays/rates lists once per
+    # batch instead of poking at per-row dicts in the inner loop
+    arrays = [sample["array"] for sample in batch[audio_column_name]]
+    sampling_rates = [sample["sampling_rate"] for sample in batch[audio_column_name]]
+
+    # decode and resample each waveform once, then run every model on the same device tensors
+    waveforms = []
+    for array, sampling_rate in zip(arrays, sampling_rates):
+        waveform = torch.from_numpy(array).float().to(device)
+        waveforms.append(resample_waveform(waveform, sampling_rate, device))
+
+    batch.update(enrich_waveforms(
+        waveforms,
+        device,
+        pitch_backend=pitch_backend,
+        penn_batch_size=penn_batch_size,
+        snr_batch_size=snr_batch_size,
+        apply_squim_quality_estimation=apply_squim_quality_estimation,
+    ))
+    return batch
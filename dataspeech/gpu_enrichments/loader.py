@@ -0,0 +1,99 @@
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from .fused import enrich_waveforms, resample_waveform
+
+
+class AudioDataset(Dataset):
+    """Wraps a HF dataset split so a DataLoader can decode audio in background workers."""
+    def __init__(self, dataset, audio_column_name="audio"):
+        # project out everything but the audio so row access doesn't
+        # deserialize the text/metadata columns too
+        self.dataset = dataset.select_columns([audio_column_name])
+        self.audio_column_name = audio_column_name
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx][self.audio_column_name]
+        return idx, torch.from_numpy(sample["array"]).float(), sample["sampling_rate"]
+
+
+def pad_collate(samples):
+    # keep variable-length waveforms as a list of tensors, padding happens on device
+    indices = [sample[0] for sample in samples]
+    waveforms = [sample[1] for sample in samples]
+    sampling_rates = [sample[2] for sample in samples]
+    return indices, waveforms, sampling_rates
+
+
+def length_sorted_batches(dataset, audio_column_name="audio", batch_size=32, num_proc=1):
+    """Group row indices into batches of similar duration.
+
+    Batches built from a length-sorted order pad to roughly their own length
+    instead of the longest clip in a random draw, so the padded forward passes
+    waste little compute on zeros. Row order of the split is untouched:
+    results are scattered back by index.
+    """
+    lengths = dataset.map(
+        lambda batch: {"n_samples": [len(sample["array"]) for sample in batch[audio_column_name]]},
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        desc="Compute audio lengths",
+    )["n_samples"]
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def enrich_split_gpu(dataset, audio_column_name="audio", batch_size=32, num_workers_per_gpu=1, cpu_num_workers=1, pitch_backend="yin", penn_batch_size=4096, snr_batch_size=32, apply_squim_quality_estimation=False):
+    """Run the GPU enrichments over a split with a single process.
+
+    Audio is decoded by DataLoader workers into pinned memory while the GPUs
+    compute, so model weights are loaded once per device instead of once per
+    worker process. Batches are round-robined across the available GPUs, each
+    on its own CUDA stream. Returns a dict of new columns aligned with the
+    split's row order.
+    """
+    devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    num_workers = num_workers_per_gpu * len(devices)
+    batches = length_sorted_batches(dataset, audio_column_name=audio_column_name, batch_size=batch_size, num_proc=cpu_num_workers)
+    loader = DataLoader(
+        AudioDataset(dataset, audio_column_name=audio_column_name),
+        batch_sampler=batches,
+        num_workers=num_workers,
+        pin_memory=True,
+        prefetch_factor=4 if num_workers > 0 else None,
+        collate_fn=pad_collate,
+    )
+    # H2D copies of the pinned batches run on their own stream so they overlap
+    # with the forward passes of the previous batch on the compute stream
+    copy_streams = {device: torch.cuda.Stream(device=device) for device in devices}
+    compute_streams = {device: torch.cuda.Stream(device=device) for device in devices}
+
+    results = {}
+    for batch_idx, (indices, waveforms, sampling_rates) in enumerate(loader):
+        device = devices[batch_idx % len(devices)]
+        with torch.cuda.stream(copy_streams[device]):
+            moved = []
+            for waveform, sampling_rate in zip(waveforms, sampling_rates):
+                waveform = waveform.to(device, non_blocking=True)
+                moved.append(resample_waveform(waveform, sampling_rate, device))
+        compute_streams[device].wait_stream(copy_streams[device])
+        with torch.cuda.stream(compute_streams[device]):
+            out = enrich_waveforms(
+                moved,
+                device,
+                pitch_backend=pitch_backend,
+                penn_batch_size=penn_batch_size,
+                snr_batch_size=snr_batch_size,
+                apply_squim_quality_estimation=apply_squim_quality_estimation,
+            )
+        for column, values in out.items():
+            results.setdefault(column, [None] * len(dataset))
+            for idx, value in zip(indices, values):
+                results[column][idx] = value.item() if isinstance(value, torch.Tensor) else value
+    for stream in compute_streams.values():
+        stream.synchronize()
+    return results
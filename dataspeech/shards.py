@@ -0,0 +1,63 @@
+import torch
+import webdataset as wds
+
+from .gpu_enrichments.fused import enrich_waveforms, resample_waveform
+
+AUDIO_EXTENSIONS = ("flac", "wav", "mp3", "ogg")
+
+
+def _find_audio(sample):
+    for extension in AUDIO_EXTENSIONS:
+        if extension in sample:
+            return sample[extension]
+    raise KeyError(f"No audio found in sample {sample['__key__']}, expected one of {AUDIO_EXTENSIONS}.")
+
+
+def enrich_shards(input_shards, output_shards, batch_size=32, buffer_batches=8, pitch_backend="yin", penn_batch_size=4096, apply_squim_quality_estimation=False, maxcount=10_000):
+    """Stream WebDataset .tar shards, enrich them and write result shards.
+
+    Shards are read sequentially so I/O stays sequential even on spinning
+    disks or NFS, and nothing is materialized back into Arrow. Samples are
+    buffered `buffer_batches` map batches at a time and sorted by length
+    within the buffer, so padded GPU batches waste little compute on padding.
+    Output shards contain one json entry per input sample (keyed by the
+    sample's `__key__`) with the enrichment columns added; audio is not
+    re-encoded.
+    """
+    device = "cuda:0" if torch.cuda.device_count() > 0 else "cpu"
+    dataset = wds.WebDataset(input_shards).decode(wds.torch_audio)
+    writer = wds.ShardWriter(output_shards, maxcount=maxcount)
+
+    def flush(buffer):
+        # bucket by length so batches pad to similar durations
+        buffer.sort(key=lambda entry: entry[1].shape[-1])
+        for start in range(0, len(buffer), batch_size):
+            chunk = buffer[start:start + batch_size]
+            waveforms = [resample_waveform(waveform.to(device), sampling_rate, device) for _, waveform, sampling_rate, _ in chunk]
+            out = enrich_waveforms(
+                waveforms,
+                device,
+                pitch_backend=pitch_backend,
+                penn_batch_size=penn_batch_size,
+                apply_squim_quality_estimation=apply_squim_quality_estimation,
+            )
+            for i, (key, _, _, meta) in enumerate(chunk):
+                meta = dict(meta)
+                for column, values in out.items():
+                    meta[column] = float(values[i])
+                writer.write({"__key__": key, "json": meta})
+        buffer.clear()
+
+    buffer = []
+    for sample in dataset:
+        waveform, sampling_rate = _find_audio(sample)
+        waveform = waveform.float()
+        if waveform.dim() > 1:
+            # downmix multichannel members to mono, squeeze(0) only handled [1, T]
+            waveform = waveform.mean(0)
+        buffer.append((sample["__key__"], waveform, sampling_rate, sample.get("json", {})))
+        if len(buffer) >= batch_size * buffer_batches:
+            flush(buffer)
+    if buffer:
+        flush(buffer)
+    writer.close()
@@ -1,8 +1,9 @@
-from datasets import load_dataset, load_from_disk, Audio, DatasetDict
-from multiprocess import set_start_method
-from dataspeech import rate_apply, pitch_apply, snr_apply, squim_apply
+from datasets import load_dataset, load_from_disk, Dataset, DatasetDict, IterableDatasetDict, concatenate_datasets
+from dataspeech import rate_apply, gpu_enrichments_apply, enrich_split_gpu, enrich_shards
 import torch
 import argparse
+import hashlib
+import sys
 import os
 
 
@@ -12,14 +13,20 @@ import os
 # - Reverberation
 
 
+def stream_examples(iterable_dataset):
+    yield from iterable_dataset
+
+
 if __name__ == "__main__":
-    set_start_method("spawn")
     parser = argparse.ArgumentParser()
     
     # Dataset loading arguments
     parser.add_argument("dataset_name", type=str, help="Path or name of the dataset. See: https://huggingface.co/docs/datasets/v2.17.0/en/package_reference/loading_methods#datasets.load_dataset.path")
     parser.add_argument("--configuration", default=None, type=str, help="Dataset configuration to use, if necessary.")
     parser.add_argument("--from_disk", action="store_true", help="If set, load dataset from disk using load_from_disk instead of load_dataset.")
+    parser.add_argument("--streaming", action="store_true", help="If set, stream the dataset instead of copying it into the HF cache first. The enrichments run lazily while the output is written, which avoids the initial full-corpus download/copy. Not compatible with --from_disk.")
+    parser.add_argument("--input_shards", default=None, type=str, help="If set, dataset_name is ignored and audio is streamed from this WebDataset .tar shard pattern (e.g. 'data/shard-{000000..000999}.tar'). Requires --output_shards.")
+    parser.add_argument("--output_shards", default=None, type=str, help="ShardWriter pattern for the enriched output shards (e.g. 'out/shard-%%06d.tar'). Only used with --input_shards.")
     
     # S3 storage options
     parser.add_argument("--aws_access_key_id", default=None, type=str, help="AWS access key ID for S3 storage.")
@@ -29,6 +36,7 @@ if __name__ == "__main__":
     # Output arguments
     parser.add_argument("--output_dir", default=None, type=str, help="If specified, save the dataset on disk with this path.")
     parser.add_argument("--repo_id", default=None, type=str, help="If specified, push the dataset to the hub.")
+    parser.add_argument("--push_num_proc", default=8, type=int, help="Number of processes used to shard and upload the dataset in parallel when pushing to the hub.")
     
     # Column arguments
     parser.add_argument("--audio_column_name", default="audio", type=str, help="Column name of the audio column to be enriched.")
@@ -38,15 +46,35 @@ if __name__ == "__main__":
     # Processing arguments
     parser.add_argument("--cpu_num_workers", default=1, type=int, help="Number of CPU workers for transformations that don't use GPUs or if no GPU are available.")
     parser.add_argument("--cpu_writer_batch_size", default=1000, type=int, help="writer_batch_size for transformations that don't use GPUs. See: https://huggingface.co/docs/datasets/v2.17.0/en/package_reference/main_classes#datasets.Dataset.map.writer_batch_size")
-    parser.add_argument("--batch_size", default=2, type=int, help="This parameters specify how many samples are passed by workers for operations that are using GPUs.")
-    parser.add_argument("--penn_batch_size", default=4096, type=int, help="Pitch estimation chunks audio into smaller pieces and processes them in batch. This specify the batch size. If you are using a gpu, pick a batch size that doesn't cause memory errors.")
-    parser.add_argument("--num_workers_per_gpu_for_pitch", default=1, type=int, help="Number of workers per GPU for the pitch estimation if GPUs are available. Defaults to 1 if some are avaiable. Useful if you want multiple processes per GPUs to maximise GPU usage.")
-    parser.add_argument("--num_workers_per_gpu_for_snr", default=1, type=int, help="Number of workers per GPU for the SNR and reverberation estimation if GPUs are available. Defaults to 1 if some are avaiable. Useful if you want multiple processes per GPUs to maximise GPU usage.")
+    parser.add_argument("--audio_writer_batch_size", default=50, type=int, help="writer_batch_size for transformations that carry audio. Audio rows are large, so the default Arrow chunk of 1000 rows can overflow the 2GB ListArray limit on long-audio datasets; keep this small.")
+    parser.add_argument("--batch_size", default=32, type=int, help="This parameters specify how many samples are passed by workers for operations that are using GPUs. Models that support batched inputs see the whole batch in a single forward pass.")
+    parser.add_argument("--pitch_backend", default="yin", type=str, choices=["yin", "penn", "crepe"], help="Pitch estimator to use. 'yin' (torch-yin) runs a single batched kernel over the whole padded batch and is the fastest on GPU; 'penn' and 'crepe' process utterances one by one.")
+    parser.add_argument("--penn_batch_size", default=4096, type=int, help="Only used with --pitch_backend penn or crepe. Pitch estimation chunks audio into smaller pieces and processes them in batch. This specify the batch size. If you are using a gpu, pick a batch size that doesn't cause memory errors.")
+    parser.add_argument("--num_workers_per_gpu", default=1, type=int, help="Number of DataLoader workers per GPU that decode audio in the background during the GPU enrichments (pitch, SNR, reverberation and optionally SQUIM). Useful to keep the GPUs fed while audio is decoded on CPU.")
     parser.add_argument("--apply_squim_quality_estimation", action="store_true", help="If set, will also use torchaudio-squim estimation (SI-SNR, STOI and PESQ).")
-    parser.add_argument("--num_workers_per_gpu_for_squim", default=1, type=int, help="Number of workers per GPU for the SI-SNR, STOI and PESQ estimation if GPUs are available. Defaults to 1 if some are avaiable. Useful if you want multiple processes per GPUs to maximise GPU usage.")
+    parser.add_argument("--num_shards", default=1, type=int, help="Split the dataset into this many contiguous shards and only process the range given by --start_shard/--stop_shard. Useful to spread a large corpus over several nodes or to resume a crashed run. Each shard range must write to its own --output_dir, otherwise concurrent runs overwrite each other's output.")
+    parser.add_argument("--start_shard", default=0, type=int, help="First shard (inclusive) to process when --num_shards > 1.")
+    parser.add_argument("--stop_shard", default=None, type=int, help="Last shard (inclusive) to process when --num_shards > 1. Defaults to the last shard.")
 
     args = parser.parse_args()
-    
+
+    if args.streaming and args.from_disk:
+        raise ValueError("--streaming is not compatible with --from_disk, load_from_disk has no streaming mode.")
+
+    if args.input_shards:
+        if not args.output_shards:
+            raise ValueError("--output_shards must be set when streaming from --input_shards.")
+        print(f"Streaming WebDataset shards from: {args.input_shards}")
+        enrich_shards(
+            args.input_shards,
+            args.output_shards,
+            batch_size=args.batch_size,
+            pitch_backend=args.pitch_backend,
+            penn_batch_size=args.penn_batch_size,
+            apply_squim_quality_estimation=args.apply_squim_quality_estimation,
+        )
+        sys.exit(0)
+
     # Setup storage options for S3 if provided
     storage_options = None
     if args.aws_access_key_id and args.aws_secret_access_key:
@@ -72,7 +100,12 @@ if __name__ == "__main__":
             dataset = load_from_disk(args.dataset_name)
     else:
         print(f"Loading dataset from hub/path: {args.dataset_name}")
-        if args.configuration:
+        if args.streaming:
+            if args.configuration:
+                dataset = load_dataset(args.dataset_name, args.configuration, streaming=True)
+            else:
+                dataset = load_dataset(args.dataset_name, streaming=True)
+        elif args.configuration:
             dataset = load_dataset(args.dataset_name, args.configuration, num_proc=args.cpu_num_workers)
         else:
             dataset = load_dataset(args.dataset_name, num_proc=args.cpu_num_workers)
@@ -82,69 +115,123 @@ if __name__ == "__main__":
     if args.rename_column:
         dataset = dataset.rename_columns({args.audio_column_name: "audio", args.text_column_name: "text"})
         
-    dataset = DatasetDict({"train": dataset})
+    if args.streaming:
+        # load_dataset(streaming=True) already returns an IterableDatasetDict;
+        # only a bare single-split IterableDataset needs wrapping
+        if not isinstance(dataset, IterableDatasetDict):
+            dataset = IterableDatasetDict({"train": dataset})
+    else:
+        dataset = DatasetDict({"train": dataset})
 
-    if args.apply_squim_quality_estimation:
-        print("Compute SI-SDR, PESQ, STOI")
-        squim_dataset = dataset.map(
-            squim_apply,
+    stop_shard = args.stop_shard if args.stop_shard is not None else args.num_shards - 1
+    if args.num_shards > 1 and not args.streaming:
+        # keep only the requested shard range, so several nodes can split the
+        # corpus and an interrupted run can restart from where it stopped
+        for split in dataset.keys():
+            dataset[split] = concatenate_datasets([
+                dataset[split].shard(num_shards=args.num_shards, index=index, contiguous=True)
+                for index in range(args.start_shard, stop_shard + 1)
+            ])
+
+    # with a stable per-stage cache file, re-running after a crash skips every
+    # stage whose Arrow file is already on disk (datasets' fingerprint cache);
+    # only possible for local output dirs, an s3:// URL would just create a
+    # bogus local directory named after it
+    is_local_output = args.output_dir and "://" not in args.output_dir
+    cache_dir = os.path.join(args.output_dir, ".cache") if is_local_output else None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    # datasets reloads explicit cache files on existence alone, ignoring the
+    # mapped function and its kwargs, so bake the args that change the stage
+    # outputs into the file names to avoid serving stale enrichments
+    stage_args = f"{args.pitch_backend}-{args.batch_size}-{args.penn_batch_size}-{args.apply_squim_quality_estimation}-{audio_column_name}-{text_column_name}"
+    args_digest = hashlib.sha1(stage_args.encode()).hexdigest()[:8]
+    shard_suffix = f"_{args.start_shard}-{stop_shard}-of-{args.num_shards}_{args_digest}"
+
+    print("Compute pitch, snr, reverb" + (", SI-SDR, PESQ, STOI" if args.apply_squim_quality_estimation else ""))
+    if args.streaming:
+        # IterableDataset maps are lazy: the GPU enrichments and the speaking
+        # rate run while Dataset.from_generator writes the final Arrow file,
+        # so the corpus is never copied into the cache beforehand
+        enriched_dataset = dataset.map(
+            gpu_enrichments_apply,
             batched=True,
             batch_size=args.batch_size,
-            with_rank=True if torch.cuda.device_count()>0 else False,
-            num_proc=torch.cuda.device_count()*args.num_workers_per_gpu_for_squim if torch.cuda.device_count()>0 else args.cpu_num_workers,
             remove_columns=[audio_column_name], # tricks to avoid rewritting audio
-            fn_kwargs={"audio_column_name": audio_column_name,},
+            fn_kwargs={"audio_column_name": audio_column_name, "pitch_backend": args.pitch_backend, "penn_batch_size": args.penn_batch_size, "apply_squim_quality_estimation": args.apply_squim_quality_estimation},
         )
-
-    print("Compute pitch")
-    pitch_dataset = dataset.cast_column(audio_column_name, Audio(sampling_rate=16_000)).map(
-        pitch_apply,
-        batched=True,
-        batch_size=args.batch_size,
-        with_rank=True if torch.cuda.device_count()>0 else False,
-        num_proc=torch.cuda.device_count()*args.num_workers_per_gpu_for_pitch if torch.cuda.device_count()>0 else args.cpu_num_workers,
-        remove_columns=[audio_column_name], # tricks to avoid rewritting audio
-        fn_kwargs={"audio_column_name": audio_column_name, "penn_batch_size": args.penn_batch_size},
-    )
-
-    print("Compute snr and reverb")
-    snr_dataset = dataset.map(
-        snr_apply,
-        batched=True,
-        batch_size=args.batch_size,
-        with_rank=True if torch.cuda.device_count()>0 else False,
-        num_proc=torch.cuda.device_count()*args.num_workers_per_gpu_for_snr if torch.cuda.device_count()>0 else args.cpu_num_workers,
-        remove_columns=[audio_column_name], # tricks to avoid rewritting audio
-        fn_kwargs={"audio_column_name": audio_column_name},
-    )
-    
-    print("Compute speaking rate")
-    if "speech_duration" in snr_dataset[next(iter(snr_dataset.keys()))].features:    
-        rate_dataset = snr_dataset.map(
+        print("Compute speaking rate")
+        rate_dataset = enriched_dataset.map(
             rate_apply,
-            with_rank=False,
-            num_proc=args.cpu_num_workers,
-            writer_batch_size= args.cpu_writer_batch_size,
+            batched=True,
+            batch_size=1024,
             fn_kwargs={"audio_column_name": audio_column_name, "text_column_name": text_column_name},
         )
+        dataset = DatasetDict({
+            split: Dataset.from_generator(stream_examples, gen_kwargs={"iterable_dataset": rate_dataset[split]})
+            for split in rate_dataset.keys()
+        })
     else:
-        rate_dataset = dataset.map(
+        if torch.cuda.device_count() > 0:
+            # single process: DataLoader workers decode audio in the background while
+            # the GPUs compute, and model weights are loaded once per GPU
+            enriched_dataset = DatasetDict()
+            for split in dataset.keys():
+                gpu_cache = os.path.join(cache_dir, f"gpu_enrichments_{split}{shard_suffix}") if cache_dir else None
+                if gpu_cache and os.path.isdir(gpu_cache):
+                    # finished GPU stage from an interrupted run, reuse it
+                    print(f"Reusing cached GPU enrichments for split '{split}'")
+                    columns_dataset = load_from_disk(gpu_cache)
+                else:
+                    new_columns = enrich_split_gpu(
+                        dataset[split],
+                        audio_column_name=audio_column_name,
+                        batch_size=args.batch_size,
+                        num_workers_per_gpu=args.num_workers_per_gpu,
+                        cpu_num_workers=args.cpu_num_workers,
+                        pitch_backend=args.pitch_backend,
+                        penn_batch_size=args.penn_batch_size,
+                        apply_squim_quality_estimation=args.apply_squim_quality_estimation,
+                    )
+                    columns_dataset = Dataset.from_dict(new_columns)
+                    if gpu_cache:
+                        columns_dataset.save_to_disk(gpu_cache)
+                # one horizontal concat instead of one Arrow rewrite per new column
+                enriched_dataset[split] = concatenate_datasets(
+                    [dataset[split].remove_columns([audio_column_name]), columns_dataset], # tricks to avoid rewritting audio
+                    axis=1,
+                )
+        else:
+            enriched_dataset = dataset.map(
+                gpu_enrichments_apply,
+                batched=True,
+                batch_size=args.batch_size,
+                num_proc=args.cpu_num_workers,
+                writer_batch_size=args.audio_writer_batch_size,
+                disable_nullable=True,
+                cache_file_names={split: os.path.join(cache_dir, f"gpu_enrichments_{split}{shard_suffix}.arrow") for split in dataset.keys()} if cache_dir else None,
+                remove_columns=[audio_column_name], # tricks to avoid rewritting audio
+                fn_kwargs={"audio_column_name": audio_column_name, "pitch_backend": args.pitch_backend, "penn_batch_size": args.penn_batch_size, "apply_squim_quality_estimation": args.apply_squim_quality_estimation},
+            )
+
+        print("Compute speaking rate")
+        # the enriched dataset always carries speech_duration and no audio, so
+        # the rate pass is purely text-based and never re-decodes audio
+        rate_dataset = enriched_dataset.map(
             rate_apply,
+            batched=True,
+            batch_size=1024,
             with_rank=False,
             num_proc=args.cpu_num_workers,
             writer_batch_size= args.cpu_writer_batch_size,
-            remove_columns=[audio_column_name], # tricks to avoid rewritting audio
+            cache_file_names={split: os.path.join(cache_dir, f"rate_{split}{shard_suffix}.arrow") for split in enriched_dataset.keys()} if cache_dir else None,
             fn_kwargs={"audio_column_name": audio_column_name, "text_column_name": text_column_name},
         )
-    
-    for split in dataset.keys():
-        dataset[split] = pitch_dataset[split].add_column("snr", snr_dataset[split]["snr"]).add_column("c50", snr_dataset[split]["c50"])
-        if "speech_duration" in snr_dataset[split]:
-            dataset[split] = dataset[split].add_column("speech_duration", snr_dataset[split]["speech_duration"])
-        dataset[split] = dataset[split].add_column("speaking_rate", rate_dataset[split]["speaking_rate"]).add_column("phonemes", rate_dataset[split]["phonemes"])
-        if args.apply_squim_quality_estimation:
-            dataset[split] = dataset[split].add_column("stoi", squim_dataset[split]["stoi"]).add_column("si-sdr", squim_dataset[split]["sdr"]).add_column("pesq", squim_dataset[split]["pesq"])
-    
+        dataset = rate_dataset
+
+    if args.apply_squim_quality_estimation:
+        dataset = dataset.rename_column("sdr", "si-sdr")
+
     if args.output_dir:
         print("Saving to disk...")
         if storage_options:
@@ -153,7 +240,8 @@ if __name__ == "__main__":
             dataset.save_to_disk(args.output_dir)
     if args.repo_id:
         print("Pushing to the hub...")
+        # num_proc > 1 prepares and uploads the parquet shards in parallel
         if args.configuration:
-            dataset.push_to_hub(args.repo_id, args.configuration)
+            dataset.push_to_hub(args.repo_id, args.configuration, num_proc=args.push_num_proc)
         else:
-            dataset.push_to_hub(args.repo_id)
+            dataset.push_to_hub(args.repo_id, num_proc=args.push_num_proc)